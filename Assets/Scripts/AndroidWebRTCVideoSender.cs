@@ -23,6 +23,15 @@ public class AndroidWebRTCVideoSender : MonoBehaviour
         public int sdpMLineIndex;
         public string roomId;
         public string peerId;
+        public IceCandidateEntry[] candidates; // set when type == "ice-candidates"
+    }
+
+    [System.Serializable]
+    private class IceCandidateEntry
+    {
+        public string candidate;
+        public string sdpMid;
+        public int sdpMLineIndex;
     }
 
     [System.Serializable]
@@ -760,11 +769,20 @@ public class AndroidWebRTCVideoSender : MonoBehaviour
                     Debug.Log("Received answer from remote peer");
                     SetRemoteDescription(msg.sdp, "answer");
                 }
-                else if (msg.type == "ice-candidate")
+                else if (msg.type == "ice-candidate" && !string.IsNullOrEmpty(msg.candidate))
                 {
                     Debug.Log("Received ICE candidate from remote peer");
                     AddIceCandidate(msg.candidate, msg.sdpMid, msg.sdpMLineIndex);
                 }
+                else if (msg.type == "ice-candidates" && msg.candidates != null)
+                {
+                    // Several candidates coalesced by the signaling server into one message
+                    Debug.Log($"Received {msg.candidates.Length} ICE candidates from remote peer");
+                    foreach (var entry in msg.candidates)
+                    {
+                        AddIceCandidate(entry.candidate, entry.sdpMid, entry.sdpMLineIndex);
+                    }
+                }
             }
         }
         catch (System.Exception e)
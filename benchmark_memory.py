@@ -0,0 +1,91 @@
+"""Reports resident bytes per queued signaling message
+
+Compares the original layout (a list mailbox holding one dict per message)
+with the slotted Message/Mailbox records in signaling-server.py, for SDP
+offers and ICE candidates.
+
+Usage: python benchmark_memory.py [message count]
+"""
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+spec = importlib.util.spec_from_file_location(
+    'signaling_server', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'signaling-server.py'))
+server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server)
+
+SDP = 'v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\n' + 'a=candidate:x\r\n' * 150
+CANDIDATE = 'candidate:842163049 1 udp 1677729535 203.0.113.7 46154 typ srflx raddr 10.0.0.2 rport 46154 generation 0'
+
+PAYLOADS = {
+    'offer': json.dumps({'type': 'offer', 'sdp': SDP, 'roomId': 'bench-room', 'peerId': 'unity-sender'}),
+    'ice-candidate': json.dumps({
+        'type': 'ice-candidate', 'candidate': CANDIDATE, 'sdpMid': '0', 'sdpMLineIndex': 0,
+        'roomId': 'bench-room', 'peerId': 'unity-sender'
+    })
+}
+
+def measure(enqueue, count):
+    """Returns bytes retained per message after enqueueing count messages"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    retained = enqueue(count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del retained
+    return (after - before) / count
+
+def enqueue_dicts(message_type, count):
+    """The original layout: each request's fields copied into a fresh dict"""
+    mailbox = []
+    for _ in range(count):
+        data = json.loads(PAYLOADS[message_type])
+        if message_type == 'ice-candidate':
+            mailbox.append({
+                'type': 'ice-candidate',
+                'candidate': data.get('candidate'),
+                'sdpMid': data.get('sdpMid', ''),
+                'sdpMLineIndex': data.get('sdpMLineIndex', 0),
+                'roomId': data.get('roomId'),
+                'peerId': data.get('peerId', 'unknown'),
+                'timestamp': time.time()
+            })
+        else:
+            mailbox.append({
+                'type': message_type,
+                'sdp': data.get('sdp'),
+                'roomId': data.get('roomId'),
+                'peerId': data.get('peerId', 'unknown'),
+                'timestamp': time.time()
+            })
+    return mailbox
+
+def enqueue_records(message_type, count):
+    """The current layout: parse_signal + relay into a receiver's Mailbox"""
+    server.MAILBOX_CAPACITY = count
+    # Every offer here comes from one sender; keep them all queued instead of compacting
+    server.SUPERSEDED_TYPES = frozenset()
+    server.rooms.clear()
+    server.take_messages('bench-room', 'unity-receiver')
+    for _ in range(count):
+        message, _ = server.parse_signal(message_type, json.loads(PAYLOADS[message_type]))
+        server.relay(message)
+    return server.rooms.pop('bench-room')
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print(f'Bytes per queued message ({count} messages, one recipient)')
+    print(f'{"type":<16}{"dict/list":>12}{"slots/deque":>14}{"saved":>10}')
+    for message_type in PAYLOADS:
+        # Payload strings are retained either way; subtract them to show per-record overhead
+        payload = sys.getsizeof(SDP if message_type == 'offer' else CANDIDATE)
+        before = measure(lambda n: enqueue_dicts(message_type, n), count) - payload
+        after = measure(lambda n: enqueue_records(message_type, n), count) - payload
+        print(f'{message_type:<16}{before:>12.0f}{after:>14.0f}{before - after:>10.0f}')
+
+if __name__ == '__main__':
+    main()
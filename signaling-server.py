@@ -1,244 +1,1893 @@
 
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from enum import Enum
+import asyncio
+import bisect
+import heapq
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import sys
 import threading
 import time
+import weakref
+
+try:
+    from aiohttp import web, WSMsgType
+except ImportError:  # only needed for SIGNALING_ENGINE=asyncio
+    web = None
 
 app = Flask(__name__)
 CORS(app)  
+sock = Sock(app)
 
 PORT = 8080
 
+# 'flask' runs the threaded Werkzeug server (one OS thread per in-flight
+# request); 'asyncio' serves the same routes from a single aiohttp event loop,
+# so parked long-polls, streams and sockets cost a coroutine instead of a thread.
+ENGINE = os.environ.get('SIGNALING_ENGINE', 'flask')
+
+# Messages older than MESSAGE_TTL seconds are dropped, and so are peers with an
+# empty mailbox that have not polled for as long. The expiry sweep runs every
+# EXPIRY_INTERVAL seconds; it only touches peers that are due, so a short
+# interval (tighter expiry precision) stays cheap.
+MESSAGE_TTL = float(os.environ.get('SIGNALING_MESSAGE_TTL', 30))
+EXPIRY_INTERVAL = float(os.environ.get('SIGNALING_EXPIRY_INTERVAL', 1))
+
+# Most messages a peer mailbox holds; past this the oldest are dropped, so a
+# peer that never polls cannot grow without bound.
+MAILBOX_CAPACITY = 256
+
+# Opt-in Nagle-style ICE coalescing: candidates from one sender that are still
+# undelivered in a recipient's mailbox merge into a single 'ice-candidates'
+# message, and a long-poll or push consumer holds an open batch for up to this
+# many ms (or until the sender's end-of-candidates) so a burst travels as one
+# message. 0 disables it.
+ICE_COALESCE_MS = int(os.environ.get('SIGNALING_ICE_COALESCE_MS', 0))
+
+# Opt-in sticky offers: a room keeps each sender's latest broadcast offer for
+# this many seconds and queues it for any peer that joins in that window, so an
+# offer posted before the receiver's first poll is not lost. A retained offer
+# is still a queued message, so it never outlives MESSAGE_TTL. 0 disables it.
+OFFER_RETAIN_TTL = min(float(os.environ.get('SIGNALING_OFFER_RETAIN_TTL', 0)), MESSAGE_TTL)
+
+# A POST carrying an Idempotency-Key header (or a top-level messageId) is
+# remembered for IDEMPOTENCY_TTL seconds, and a retry with the same key gets the
+# original acknowledgement back instead of being relayed again. At most
+# IDEMPOTENCY_CAPACITY keys are kept; the oldest are forgotten first.
+IDEMPOTENCY_TTL = float(os.environ.get('SIGNALING_IDEMPOTENCY_TTL', 60))
+IDEMPOTENCY_CAPACITY = 4096
+
+# With SIGNALING_QUEUED_MS=1 every delivered message also carries queuedMs:
+# how long it waited in the server between enqueue and this delivery.
+QUEUED_MS_FIELD = os.environ.get('SIGNALING_QUEUED_MS', '').lower() in ('1', 'true')
+
+# Upper bound for the opt-in long-poll on GET /messages (?wait=<ms>). Any parked
+# wait (long-poll, SSE or WebSocket) is further held to half of MESSAGE_TTL, so
+# a parked peer is never reaped mid-wait, leaving it on a Condition nothing
+# will notify.
+MAX_POLL_WAIT_MS = 20000
+MAX_PARK_MS = min(MAX_POLL_WAIT_MS, MESSAGE_TTL * 1000 / 2)
+
+# How long a WebSocket pusher parks on the mailbox before re-checking that the
+# socket is still open. Delivery itself is immediate; this only bounds shutdown.
+WS_PUSH_WAIT_MS = 1000
+
+# GET /events sends a comment frame after this much idle time so proxies keep
+# the stream open, and keeps the last SSE_REPLAY_SIZE events per peer so a
+# reconnecting EventSource can resume from its Last-Event-ID.
+SSE_HEARTBEAT_MS = 15000
+SSE_REPLAY_SIZE = 64
+
+# Roles a peer may declare with a 'role' field on any signal it sends. Declaring
+# 'broadcaster' turns its room into a star: viewers only ever signal the
+# broadcaster, so a room of N viewers relays O(N) messages instead of O(N^2).
+# 'viewer' hands the room back to mesh if the sender was its broadcaster.
+PEER_ROLES = ('broadcaster', 'viewer')
+
+# GET /metrics histogram bucket upper bounds (Prometheus 'le'); +Inf is implied.
+# Latency buckets reach past MAX_POLL_WAIT_MS so parked long-polls still land
+# in a finite bucket.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+METRIC_ROUTES = ('/offer', '/answer', '/ice-candidate', '/messages')
+
+# Structured log: one JSON object per line on stdout, written by a background
+# thread so handlers only enqueue. Events below SIGNALING_LOG_LEVEL (debug,
+# info, warning, error) are dropped, and SIGNALING_LOG_SAMPLE keeps only a
+# fraction of the named events, e.g. 'poll=0.01,ice-candidate=0.1' (0 turns an
+# event off). Past LOG_QUEUE_SIZE pending lines new ones are dropped and counted.
+# Both settings are validated at startup, see parse_log_level/parse_log_sample.
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+LOG_LEVEL_NAME = os.environ.get('SIGNALING_LOG_LEVEL', 'info')
+LOG_SAMPLE_SPEC = os.environ.get('SIGNALING_LOG_SAMPLE', '')
+LOG_QUEUE_SIZE = 10000
+
+# Connection-setup timelines, one per (offerer, answerer) pair in a room: the
+# last SETUP_HISTORY finished negotiations are kept for the percentiles on GET
+# /setup and the JSON lines on GET /setup/log. A negotiation finishes once it
+# has an answer and no ICE candidate for SETUP_QUIET_MS, on renegotiation, or
+# when either peer expires.
+SETUP_HISTORY = 1000
+SETUP_QUIET_MS = 5000
+SETUP_PERCENTILES = (50, 90, 99)
+
+# Registry of rooms: room id -> Room. Each room is guarded
+# by one of ROOM_LOCK_STRIPES locks picked by hash of its id, so unrelated
+# rooms rarely contend and no single lock serializes the whole server.
+ROOM_LOCK_STRIPES = 64
 
 rooms = {}
-rooms_lock = threading.Lock()
+room_locks = [threading.Lock() for _ in range(ROOM_LOCK_STRIPES)]
+
+# Per-stripe min-heaps of (deadline, room id, peer id), guarded by the stripe's
+# lock. Every peer has exactly one live entry, at or before its next possible
+# expiry; entries for peers that were removed or rescheduled are skipped lazily.
+expiry_heaps = [[] for _ in range(ROOM_LOCK_STRIPES)]
+
+def room_stripe(room_id):
+    """Returns the lock stripe index of a room"""
+    return hash(room_id) % ROOM_LOCK_STRIPES
+
+def room_lock(room_id):
+    """Returns the lock guarding a room and its peers"""
+    return room_locks[room_stripe(room_id)]
+
+def intern_id(value):
+    """Interns a room or peer id so every record referencing it shares one string"""
+    return sys.intern(value) if type(value) is str else value
+
+def parse_log_level(name):
+    """Returns the numeric SIGNALING_LOG_LEVEL, exiting on an unknown level"""
+    if name not in LOG_LEVELS:
+        raise SystemExit(f'Unknown SIGNALING_LOG_LEVEL: {name} (expected debug, info, warning or error)')
+    return LOG_LEVELS[name]
+
+def parse_log_sample(spec):
+    """Parses SIGNALING_LOG_SAMPLE ('event=rate,...') into {event: rate}, exiting on a malformed entry"""
+    sample = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        event, _, rate = item.partition('=')
+        try:
+            rate = float(rate)
+        except ValueError:
+            rate = None
+        if not event.strip() or rate is None or not 0 <= rate <= 1:
+            raise SystemExit(f'Invalid SIGNALING_LOG_SAMPLE entry: {item!r} (expected event=rate with rate in 0..1, '
+                             f'e.g. poll=0.01)')
+        sample[event.strip()] = rate
+    return sample
+
+LOG_LEVEL = parse_log_level(LOG_LEVEL_NAME)
+LOG_SAMPLE = parse_log_sample(LOG_SAMPLE_SPEC)
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+# Lines dropped on a full queue since the last write (unlocked, so approximate)
+log_dropped = 0
+
+def log(level, event, **fields):
+    """Queues a structured log line, unless its level is filtered out or the event isn't sampled"""
+    global log_dropped
+    if LOG_LEVELS[level] < LOG_LEVEL:
+        return
+    rate = LOG_SAMPLE.get(event)
+    if rate is not None and random.random() >= rate:
+        return
+    try:
+        log_queue.put_nowait((time.time(), level, event, fields))
+    except queue.Full:
+        log_dropped += 1
+
+def write_logs():
+    """Writes queued log lines to stdout as JSON, a whole backlog per write"""
+    global log_dropped
+    while True:
+        entries = [log_queue.get()]
+        while True:
+            try:
+                entries.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        if log_dropped:
+            entries.append((time.time(), 'warning', 'log_dropped', {'count': log_dropped}))
+            log_dropped = 0
+        
+        sys.stdout.write(''.join(
+            json.dumps({'time': datetime.fromtimestamp(when).isoformat(), 'level': level, 'event': event, **fields},
+                       default=str) + '\n'
+            for when, level, event, fields in entries
+        ))
+        sys.stdout.flush()
+
+log_thread = threading.Thread(target=write_logs, daemon=True)
+log_thread.start()
+
+class MessageType(Enum):
+    """Signaling message types, shared by every queued Message"""
+    OFFER = 'offer'
+    ANSWER = 'answer'
+    ICE_CANDIDATE = 'ice-candidate'
+    ICE_CANDIDATES = 'ice-candidates'
+
+class Message:
+    """A relayed signaling message
+
+    Slotted and with interned room/peer ids and a shared MessageType, so a
+    queued message costs a fixed-size record instead of a dict that repeats
+    every key and id string. relay() stamps it once and queues the same object
+    for every recipient, so it must not be modified after that; its JSON is
+    encoded on first delivery and reused for every later recipient.
+    
+    An SDP message relayed through pass-through ingress keeps the sender's own
+    JSON text in raw (minus the closing brace) instead of a decoded sdp, and is
+    delivered as that text plus the enqueue timestamp.
+    """
+    __slots__ = ('type', 'room_id', 'peer_id', 'target_peer_id', 'timestamp', 'sdp', 'candidate', 'sdp_mid',
+                 'sdp_m_line_index', 'raw', 'encoded', 'role')
+    
+    def __init__(self, type, room_id, peer_id, sdp=None, candidate=None, sdp_mid=None, sdp_m_line_index=None,
+                 timestamp=None, raw=None, target_peer_id=None, role=None):
+        self.type = type
+        self.room_id = intern_id(room_id)
+        self.peer_id = intern_id(peer_id)
+        # None broadcasts to every other peer in the room
+        self.target_peer_id = intern_id(target_peer_id)
+        self.timestamp = timestamp
+        self.sdp = sdp
+        self.candidate = candidate
+        self.sdp_mid = sdp_mid
+        self.sdp_m_line_index = sdp_m_line_index
+        self.raw = raw
+        self.encoded = None
+        # Sender's declared PEER_ROLES entry, applied to the room on relay
+        self.role = role
+    
+    def encode(self):
+        """Returns the message as JSON text, encoding it only the first time"""
+        # Racing deliveries may both encode; they produce the same text
+        if self.encoded is None:
+            if self.raw is not None:
+                self.encoded = f'{self.raw},"timestamp":{self.timestamp!r}}}'
+            else:
+                self.encoded = json.dumps(self.to_json(), separators=(',', ':'))
+        return self.encoded
+    
+    def to_json(self):
+        """Returns the message in the JSON shape clients expect"""
+        if self.raw is not None:
+            return json.loads(self.encode())
+        if self.type is MessageType.ICE_CANDIDATE:
+            return {
+                'type': self.type.value,
+                'candidate': self.candidate,
+                'sdpMid': self.sdp_mid,
+                'sdpMLineIndex': self.sdp_m_line_index,
+                'roomId': self.room_id,
+                'peerId': self.peer_id,
+                'timestamp': self.timestamp
+            }
+        return {
+            'type': self.type.value,
+            'sdp': self.sdp,
+            'roomId': self.room_id,
+            'peerId': self.peer_id,
+            'timestamp': self.timestamp
+        }
+
+class CandidateBatch(Message):
+    """ICE candidates from one sender coalesced in one recipient's mailbox
+
+    Unlike other messages it belongs to a single recipient and grows while it
+    sits in the mailbox; it is closed by the sender's end-of-candidates or
+    when first encoded for delivery. A batch of one is delivered as a plain
+    'ice-candidate' message.
+    """
+    __slots__ = ('candidates', 'closed')
+    
+    def __init__(self, message):
+        super().__init__(MessageType.ICE_CANDIDATES, message.room_id, message.peer_id, timestamp=message.timestamp)
+        self.candidates = [message]
+        self.closed = False
+    
+    def encode(self):
+        self.closed = True
+        if len(self.candidates) == 1:
+            return self.candidates[0].encode()
+        return super().encode()
+    
+    def to_json(self):
+        return {
+            'type': self.type.value,
+            'candidates': [
+                {
+                    'candidate': message.candidate,
+                    'sdpMid': message.sdp_mid,
+                    'sdpMLineIndex': message.sdp_m_line_index
+                }
+                for message in self.candidates
+            ],
+            'roomId': self.room_id,
+            'peerId': self.peer_id,
+            'timestamp': self.timestamp
+        }
+
+# What a new offer makes obsolete in a recipient's mailbox: the sender's
+# earlier negotiation, which the recipient would only apply and then discard.
+SUPERSEDED_TYPES = frozenset((MessageType.OFFER, MessageType.ICE_CANDIDATE, MessageType.ICE_CANDIDATES))
+
+def encode_messages(messages):
+    """Joins pre-encoded messages into the JSON array clients poll for"""
+    now = time.time()
+    return '[' + ','.join(encode_delivery(message, now) for message in messages) + ']'
+
+def encode_delivery(message, now):
+    """Returns a message's JSON for one delivery, prefixed with its queuedMs when QUEUED_MS_FIELD is set"""
+    text = message.encode()
+    if not QUEUED_MS_FIELD:
+        return text
+    # The cached JSON is shared by every recipient, so the per-delivery field is spliced in front
+    return f'{{"queuedMs":{int((now - message.timestamp) * 1000)},{text.lstrip()[1:]}'
+
+class Histogram:
+    """Prometheus-style histogram: per-bucket counts plus the sum and count of observations"""
+    __slots__ = ('bounds', 'buckets', 'sum', 'count')
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+    
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def merge(self, other):
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.sum += other.sum
+        self.count += other.count
+
+class MetricsShard:
+    """Metrics written by one thread at a time (see ShardLease), so recording needs no lock
+
+    GET /metrics sums every shard; see local_metrics.
+    """
+    __slots__ = ('requests', 'latency', 'fan_out', 'mailbox_depth', 'queue_delay', 'expired')
+    
+    def __init__(self):
+        # (route, status code) -> count
+        self.requests = {}
+        # route -> Histogram of seconds
+        self.latency = {}
+        self.fan_out = Histogram(COUNT_BUCKETS)
+        self.mailbox_depth = Histogram(COUNT_BUCKETS)
+        # Message type value -> Histogram of seconds from enqueue to drain
+        self.queue_delay = {}
+        self.expired = 0
+    
+    def observe_request(self, route, status, seconds):
+        key = (route, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        latency = self.latency.get(route)
+        if latency is None:
+            latency = self.latency[route] = Histogram(LATENCY_BUCKETS)
+        latency.observe(seconds)
+    
+    def observe_drain(self, messages):
+        """Records a drained mailbox's depth and how long each message waited in it"""
+        self.mailbox_depth.observe(len(messages))
+        now = time.time()
+        for message in messages:
+            # A coalesced batch is timed per candidate, as plain ICE candidates are
+            for queued in message.candidates if message.type is MessageType.ICE_CANDIDATES else (message,):
+                delay = self.queue_delay.get(queued.type.value)
+                if delay is None:
+                    delay = self.queue_delay[queued.type.value] = Histogram(LATENCY_BUCKETS)
+                delay.observe(now - queued.timestamp)
+    
+    def merge(self, other):
+        # Copied first: other may be a live shard its thread is still writing
+        for key, count in list(other.requests.items()):
+            self.requests[key] = self.requests.get(key, 0) + count
+        for route, histogram in list(other.latency.items()):
+            if route not in self.latency:
+                self.latency[route] = Histogram(LATENCY_BUCKETS)
+            self.latency[route].merge(histogram)
+        self.fan_out.merge(other.fan_out)
+        self.mailbox_depth.merge(other.mailbox_depth)
+        for message_type, histogram in list(other.queue_delay.items()):
+            if message_type not in self.queue_delay:
+                self.queue_delay[message_type] = Histogram(LATENCY_BUCKETS)
+            self.queue_delay[message_type].merge(histogram)
+        self.expired += other.expired
+
+class ShardLease:
+    """A thread's claim on a pooled MetricsShard
+
+    Referenced only from that thread's metrics_local, so it is collected when
+    the thread ends, and its finalizer hands the shard back to the pool.
+    """
+    __slots__ = ('shard', '__weakref__')
+    
+    def __init__(self, shard):
+        self.shard = shard
+
+# Every shard ever created; a shard belongs to at most one live thread at a
+# time, and ones freed by finished threads wait in metrics_pool for the next
+# thread. With Werkzeug's thread per connection the pool is as large as the
+# peak concurrency, and claiming or freeing a shard is a single atomic deque
+# or list operation, so recording never takes a lock.
+metrics_local = threading.local()
+metrics_shards = []
+metrics_pool = deque()
+
+def local_metrics():
+    """Returns the calling thread's MetricsShard, leasing one from the pool on first use"""
+    lease = getattr(metrics_local, 'lease', None)
+    if lease is None:
+        try:
+            shard = metrics_pool.pop()
+        except IndexError:
+            shard = MetricsShard()
+            metrics_shards.append(shard)
+        lease = metrics_local.lease = ShardLease(shard)
+        weakref.finalize(lease, metrics_pool.append, shard)
+    return lease.shard
+
+def collect_metrics():
+    """Returns a MetricsShard summing every thread's metrics"""
+    total = MetricsShard()
+    for shard in list(metrics_shards):
+        total.merge(shard)
+    return total
+
+class StripeCounts:
+    """Running room, peer and pending message totals for one lock stripe
+
+    Updated under the stripe's lock as state changes, so GET /status sums
+    ROOM_LOCK_STRIPES records instead of walking every room and peer.
+    """
+    __slots__ = ('rooms', 'peers', 'messages')
+    
+    def __init__(self):
+        self.rooms = 0
+        self.peers = 0
+        self.messages = 0
+
+stripe_counts = [StripeCounts() for _ in range(ROOM_LOCK_STRIPES)]
+
+class Mailbox:
+    """Time-ordered queue of a peer's pending messages
+
+    Messages are appended in timestamp order, so expiry pops from the head and
+    draining swaps in a fresh deque; append, drain and per-message expiry are
+    all constant time. Every change is reflected in the stripe's counts.
+    """
+    __slots__ = ('queue', 'counts')
+    
+    def __init__(self, counts, messages=()):
+        self.queue = deque(messages, maxlen=MAILBOX_CAPACITY)
+        self.counts = counts
+        counts.messages += len(self.queue)
+    
+    def __len__(self):
+        return len(self.queue)
+    
+    def append(self, message):
+        queue = self.queue
+        # A full deque drops its oldest message, so the count stays the same
+        if len(queue) < MAILBOX_CAPACITY:
+            self.counts.messages += 1
+        queue.append(message)
+    
+    def drain(self):
+        """Removes and returns every pending message, oldest first"""
+        queue = self.queue
+        self.queue = deque(maxlen=MAILBOX_CAPACITY)
+        self.counts.messages -= len(queue)
+        return queue
+    
+    def requeue(self, messages):
+        """Puts drained messages back in front of anything queued since"""
+        queue = deque(messages, maxlen=MAILBOX_CAPACITY)
+        queue.extend(self.queue)
+        self.counts.messages += len(queue) - len(self.queue)
+        self.queue = queue
+    
+    def supersede(self, peer_id):
+        """Drops undelivered offers and ICE candidates from peer_id, returns how many were dropped"""
+        queue = self.queue
+        kept = deque((message for message in queue
+                      if message.peer_id != peer_id or message.type not in SUPERSEDED_TYPES), maxlen=MAILBOX_CAPACITY)
+        dropped = len(queue) - len(kept)
+        if dropped:
+            self.queue = kept
+            self.counts.messages -= dropped
+        return dropped
+    
+    def expire(self, cutoff):
+        """Drops messages enqueued before cutoff, returns how many were dropped"""
+        queue = self.queue
+        expired = 0
+        while queue and queue[0].timestamp <= cutoff:
+            queue.popleft()
+            expired += 1
+        self.counts.messages -= expired
+        return expired
+    
+    def oldest_timestamp(self):
+        return self.queue[0].timestamp if self.queue else None
+
+class PeerEvent(asyncio.Event):
+    """asyncio.Event with the notify_all() that deliver() calls on a Condition"""
+    notify_all = asyncio.Event.set
+
+class Peer:
+    """A peer's mailbox plus the bookkeeping the transports and expiry need"""
+    __slots__ = ('mailbox', 'last_poll', 'expires_at', 'wakeup', 'sent_events', 'last_event_id', 'unacked',
+                 'stream')
+    
+    def __init__(self, room_id):
+        self.mailbox = Mailbox(stripe_counts[room_stripe(room_id)])
+        self.last_poll = time.time()
+        self.expires_at = None
+        # Flask: bound to the room lock so a parked long-poll releases it while waiting
+        self.wakeup = PeerEvent() if ENGINE == 'asyncio' else threading.Condition(room_lock(room_id))
+        # Created by the first SSE stream, see number_events
+        self.sent_events = None
+        # Per-peer sequence shared by SSE event ids and acknowledged polls
+        self.last_event_id = 0
+        # Created by the first ?ack= poll, see release_acked
+        self.unacked = None
+        # Generation of the peer's current SSE stream, see open_stream
+        self.stream = 0
+
+class Room:
+    """The peers currently registered in a room, plus its broadcaster when it is a star"""
+    __slots__ = ('peers', 'broadcaster', 'offers', 'timelines')
+    
+    def __init__(self):
+        self.peers = {}
+        # None: mesh, every message reaches every other peer
+        self.broadcaster = None
+        # Sender peer id -> its latest broadcast offer, see OFFER_RETAIN_TTL
+        self.offers = {}
+        # (offerer, answerer) -> SetupTimeline of their negotiation in progress,
+        # from its first offer on; a star has one per viewer
+        self.timelines = {}
+
+class SetupTimeline:
+    """When one offerer/answerer negotiation reached each step, as server clock times
+
+    The *_delivered times are when the recipient drained the message, so the
+    gaps separate server queueing and polling cadence from client work.
+    """
+    __slots__ = ('room_id', 'offerer', 'answerer', 'offer', 'offer_delivered', 'answer', 'answer_delivered',
+                 'first_candidate', 'last_candidate')
+    
+    def __init__(self, room_id, offerer, answerer, offer):
+        self.room_id = room_id
+        self.offerer = offerer
+        self.answerer = answerer
+        self.offer = offer
+        self.offer_delivered = None
+        self.answer = None
+        self.answer_delivered = None
+        self.first_candidate = None
+        self.last_candidate = None
+    
+    def durations(self):
+        """Returns the step-to-step gaps in ms; None where a step never happened"""
+        def gap(start, end):
+            return None if start is None or end is None else round((end - start) * 1000, 1)
+        return {
+            'offerToAnswer': gap(self.offer, self.answer),
+            'offerToLastCandidate': gap(self.offer, self.last_candidate),
+            'offerQueued': gap(self.offer, self.offer_delivered),
+            'answerTime': gap(self.offer_delivered, self.answer),
+            'answerQueued': gap(self.answer, self.answer_delivered)
+        }
+    
+    def to_json(self):
+        return {
+            'roomId': self.room_id,
+            'offererId': self.offerer,
+            'answererId': self.answerer,
+            'offer': self.offer,
+            'offerDelivered': self.offer_delivered,
+            'answer': self.answer,
+            'answerDelivered': self.answer_delivered,
+            'firstCandidate': self.first_candidate,
+            'lastCandidate': self.last_candidate,
+            **self.durations()
+        }
+
+def get_room(room_id):
+    """Returns a room, registering it on first use (caller holds its room lock)"""
+    room = rooms.get(room_id)
+    if room is None:
+        room = rooms[intern_id(room_id)] = Room()
+        stripe_counts[room_stripe(room_id)].rooms += 1
+    return room
+
+def get_peer(room_id, peer_id):
+    """Returns a peer, creating the room and peer on first use (caller holds its room lock)"""
+    room = get_room(room_id)
+    peer = room.peers.get(peer_id)
+    if peer is None:
+        peer = room.peers[intern_id(peer_id)] = Peer(room_id)
+        stripe_counts[room_stripe(room_id)].peers += 1
+        if room.offers:
+            deliver_retained_offers(room, peer_id, peer)
+        # A retained offer is older than the peer, so it may be due first
+        oldest = peer.mailbox.oldest_timestamp()
+        schedule_expiry(room_id, peer_id, peer, (oldest or peer.last_poll) + MESSAGE_TTL)
+    return peer
+
+def deliver_retained_offers(room, peer_id, peer):
+    """Queues the room's unexpired retained offers for a peer that just joined (caller holds the room lock)"""
+    cutoff = time.time() - OFFER_RETAIN_TTL
+    for sender, offer in sorted(room.offers.items(), key=lambda item: item[1].timestamp):
+        if offer.timestamp <= cutoff:
+            del room.offers[sender]
+        elif sender != peer_id and room.broadcaster in (None, sender, peer_id):
+            track_setup(room, offer, (peer_id,))
+            deliver(peer, offer)
+
+def schedule_expiry(room_id, peer_id, peer, deadline):
+    """Sets a peer's single expiry heap entry (caller holds the room lock)"""
+    peer.expires_at = deadline
+    heapq.heappush(expiry_heaps[room_stripe(room_id)], (deadline, room_id, peer_id))
+
+def deliver(peer, message):
+    """Appends a message to a peer mailbox and wakes any parked long-poll (caller holds the room lock)"""
+    peer.mailbox.append(message)
+    peer.wakeup.notify_all()
+
+def expire_peer(room_id, peer_id, now):
+    """Drops a due peer's expired messages, then removes or reschedules the peer (caller holds the room lock)"""
+    room = rooms[room_id]
+    peers = room.peers
+    peer = peers[peer_id]
+    
+    mailbox = peer.mailbox
+    local_metrics().expired += mailbox.expire(now - MESSAGE_TTL)
+    
+    if mailbox:
+        schedule_expiry(room_id, peer_id, peer, mailbox.oldest_timestamp() + MESSAGE_TTL)
+    elif (now - peer.last_poll) > MESSAGE_TTL:
+        counts = stripe_counts[room_stripe(room_id)]
+        del peers[peer_id]
+        counts.peers -= 1
+        for key in [key for key in room.timelines if peer_id in key]:
+            finish_setup(room.timelines.pop(key))
+        if room.broadcaster == peer_id:
+            # A star without its broadcaster would route every viewer into a dead mailbox
+            log('info', 'topology', roomId=room_id, broadcaster=None, topology='mesh')
+            room.broadcaster = None
+        if len(peers) == 0:
+            del rooms[room_id]
+            counts.rooms -= 1
+    else:
+        schedule_expiry(room_id, peer_id, peer, peer.last_poll + MESSAGE_TTL)
 
 def cleanup_old_messages():
     while True:
-        time.sleep(10)  
+        time.sleep(EXPIRY_INTERVAL)
         now = time.time()
-        max_age = 30  
-        
-        with rooms_lock:
-            rooms_to_delete = []
-            for room_id, peers in rooms.items():
-                peers_to_delete = []
-                for peer_id, peer_data in peers.items():
-                    peer_data['messages'] = [
-                        msg for msg in peer_data['messages']
-                        if (now - msg['timestamp']) < max_age
-                    ]
-                    
-                    if len(peer_data['messages']) == 0 and (now - peer_data['lastPoll']) > max_age:
-                        peers_to_delete.append(peer_id)
-                
-                for peer_id in peers_to_delete:
-                    del peers[peer_id]
-                
-                if len(peers) == 0:
-                    rooms_to_delete.append(room_id)
-            
-            for room_id in rooms_to_delete:
-                del rooms[room_id]
+        
+        # Pop only the entries that are due, one lock stripe at a time
+        for stripe, heap in enumerate(expiry_heaps):
+            with room_locks[stripe]:
+                while heap and heap[0][0] <= now:
+                    deadline, room_id, peer_id = heapq.heappop(heap)
+                    room = rooms.get(room_id)
+                    peer = room.peers.get(peer_id) if room else None
+                    # Stale entry: the peer was removed or rescheduled since
+                    if peer is None or peer.expires_at != deadline:
+                        continue
+                    expire_peer(room_id, peer_id, now)
+        
+        finish_quiet_setups(now)
 
 cleanup_thread = threading.Thread(target=cleanup_old_messages, daemon=True)
 cleanup_thread.start()
 
-@app.route('/offer', methods=['POST'])
-def handle_offer():
-    """Receives an offer from a peer (usually the Android phone)"""
-    try:
-        data = request.json
+# (message type, room id, peer id, idempotency key) -> (expiry, response body,
+# status), oldest first; body is None while the first request is still being
+# relayed. Every entry lives IDEMPOTENCY_TTL from its last write, and writes move
+# it to the end, so insertion order is expiry order.
+idempotency_cache = OrderedDict()
+idempotency_lock = threading.Lock()
+
+def claim_signal(key):
+    """Reserves an idempotency key for relaying, returns None when the caller now owns it
+
+    Otherwise returns the (body, status) to answer the retry with: the first
+    request's acknowledgement, or 409 while that request is still in flight.
+    """
+    now = time.time()
+    with idempotency_lock:
+        while idempotency_cache and next(iter(idempotency_cache.values()))[0] <= now:
+            idempotency_cache.popitem(last=False)
+        entry = idempotency_cache.get(key)
+        if entry is None:
+            idempotency_cache[key] = (now + IDEMPOTENCY_TTL, None, None)
+            while len(idempotency_cache) > IDEMPOTENCY_CAPACITY:
+                idempotency_cache.popitem(last=False)
+            return None
+    
+    if entry[1] is None:
+        return {'error': 'A request with this idempotency key is still being processed'}, 409
+    return dict(entry[1]), entry[2]
+
+def settle_signal(key, body, status):
+    """Caches a claimed key's acknowledgement, or releases the key if the request failed so a retry can relay"""
+    with idempotency_lock:
+        if status != 200:
+            idempotency_cache.pop(key, None)
+            return
+        idempotency_cache[key] = (time.time() + IDEMPOTENCY_TTL, dict(body), status)
+        idempotency_cache.move_to_end(key)
+
+def parse_signal(message_type, data, raw=None):
+    """Validates a signaling payload and builds the message relayed to the other peers
+
+    raw is the payload's original JSON text, when available. Offers and
+    answers are then relayed verbatim (see pass_through) rather than decoded
+    into a Message and re-encoded for delivery.
+
+    Returns (message, error); exactly one of them is None.
+    """
+    room_id = data.get('roomId')
+    peer_id = data.get('peerId', 'unknown')
+    target_peer_id = data.get('targetPeerId')
+    role = data.get('role')
+    
+    if message_type == 'ice-candidate':
+        candidate = data.get('candidate')
+        # An empty candidate string is the standard end-of-candidates marker,
+        # relayed like any other candidate
+        if candidate is None or not room_id:
+            return None, 'Missing required fields: candidate, roomId'
+    else:
         sdp = data.get('sdp')
-        room_id = data.get('roomId')
-        peer_id = data.get('peerId', 'unknown')
-        
         if not sdp or not room_id:
-            return jsonify({'error': 'Missing required fields: sdp, roomId'}), 400
+            return None, 'Missing required fields: sdp, roomId'
+    
+    if target_peer_id is not None and not isinstance(target_peer_id, str):
+        return None, 'Invalid field: targetPeerId must be a string'
+    if target_peer_id is not None and target_peer_id == peer_id:
+        return None, 'Invalid field: targetPeerId must differ from peerId'
+    
+    if role is not None and role not in PEER_ROLES:
+        return None, 'Invalid field: role must be broadcaster or viewer'
+    
+    if message_type == 'ice-candidate':
+        return Message(
+            MessageType.ICE_CANDIDATE, room_id, peer_id,
+            candidate=candidate,
+            sdp_mid=data.get('sdpMid', ''),
+            sdp_m_line_index=data.get('sdpMLineIndex', 0),
+            target_peer_id=target_peer_id,
+            role=role
+        ), None
+    
+    prefix = pass_through(message_type, data, raw) if raw is not None else None
+    if prefix is not None:
+        return Message(MessageType(message_type), room_id, peer_id, raw=prefix, target_peer_id=target_peer_id,
+                       role=role), None
+    return Message(MessageType(message_type), room_id, peer_id, sdp=sdp, target_peer_id=target_peer_id, role=role), None
+
+# Fields the server writes into delivered messages. A verbatim body carrying
+# one of them would let the sender's value shadow the server's (e.g. a forged
+# seq that acknowledges every pending message), so such bodies are re-encoded.
+SERVER_FIELDS = ('timestamp', 'seq', 'queuedMs')
+
+def pass_through(message_type, data, raw):
+    """Returns the sender's JSON text, reopened so the enqueue timestamp can be appended
+
+    The body was already parsed once for validation, so it is well-formed JSON.
+    Defaulted fields are appended; None when it can't be relayed verbatim.
+    """
+    if data.get('type', message_type) != message_type or any(field in data for field in SERVER_FIELDS):
+        return None
+    
+    prefix = raw.rstrip()[:-1]
+    if 'type' not in data:
+        prefix += f',"type":"{message_type}"'
+    if 'peerId' not in data:
+        prefix += ',"peerId":"unknown"'
+    return prefix
+
+def fan_out(room, message):
+    """Queues a message for its target, or every peer except its sender, returns the recipient count (caller holds the room lock)"""
+    if message.role is not None:
+        assign_role(room, message)
+    
+    broadcaster = room.broadcaster
+    if broadcaster is not None and message.peer_id != broadcaster:
+        # Star: a viewer's messages go to the broadcaster only, never to other viewers
+        targets = [broadcaster] if message.target_peer_id in (None, broadcaster) else []
+    elif message.target_peer_id is not None:
+        # Directed: exactly one mailbox, created if the target hasn't polled yet
+        targets = [message.target_peer_id]
+    else:
+        # Get all other peers in the room
+        targets = [pid for pid in room.peers if pid != message.peer_id]
+    recipients = [get_peer(message.room_id, pid) for pid in targets]
+    
+    # Forward the one shared message to the recipients
+    message.timestamp = time.time()
+    local_metrics().fan_out.observe(len(recipients))
+    track_setup(room, message, targets)
+    if ICE_COALESCE_MS and message.type is MessageType.ICE_CANDIDATE:
+        for peer in recipients:
+            coalesce_candidate(peer, message)
+    elif message.type is MessageType.OFFER:
+        # Renegotiation: the new offer replaces the sender's pending offers and candidates
+        for peer in recipients:
+            peer.mailbox.supersede(message.peer_id)
+            deliver(peer, message)
+    else:
+        for peer in recipients:
+            deliver(peer, message)
+    
+    # Retained after delivery, so a recipient created above doesn't get it twice
+    if OFFER_RETAIN_TTL and message.type is MessageType.OFFER and message.target_peer_id is None:
+        room.offers[message.peer_id] = message
+    
+    # Register the sender too: expiry is scheduled per peer, so a room is only
+    # ever reaped through its peers, even if nobody has polled it yet
+    get_peer(message.room_id, message.peer_id)
+    
+    return len(recipients)
+
+def track_setup(room, message, targets):
+    """Stamps a relayed message's step on the setup timelines it belongs to (caller holds the room lock)
+
+    targets are the recipients' peer ids: an offer opens a timeline per
+    recipient, while an answer or candidate only stamps the timelines of
+    pairs whose offer is already tracked.
+    """
+    timelines = room.timelines
+    sender = message.peer_id
+    if message.type is MessageType.OFFER:
+        for answerer in targets:
+            timeline = timelines.get((sender, answerer))
+            if timeline is not None and timeline.answer is not None:
+                # Renegotiation: the previous setup is over, time the new one
+                finish_setup(timeline)
+                timeline = None
+            if timeline is None:
+                timelines[sender, answerer] = SetupTimeline(message.room_id, sender, answerer, message.timestamp)
+    elif not timelines:
+        return
+    elif message.type is MessageType.ANSWER:
+        for offerer in targets:
+            timeline = timelines.get((offerer, sender))
+            if timeline is not None and timeline.answer is None:
+                timeline.answer = message.timestamp
+                schedule_setup_finish(message.room_id, timeline, message.timestamp + SETUP_QUIET_MS / 1000)
+    elif message.candidate:
+        # Either side of a pair trickles candidates
+        for peer_id in targets:
+            for key in ((sender, peer_id), (peer_id, sender)):
+                timeline = timelines.get(key)
+                if timeline is not None:
+                    if timeline.first_candidate is None:
+                        timeline.first_candidate = message.timestamp
+                    timeline.last_candidate = message.timestamp
+
+def track_delivery(room_id, peer_id, messages):
+    """Stamps when peer_id first drained the offer or answer of a setup it is part of (caller holds the room lock)"""
+    timelines = rooms[room_id].timelines
+    if not timelines:
+        return
+    now = time.time()
+    for message in messages:
+        if message.type is MessageType.OFFER:
+            timeline = timelines.get((message.peer_id, peer_id))
+            if timeline is not None and timeline.offer_delivered is None and message.timestamp >= timeline.offer:
+                timeline.offer_delivered = now
+        elif message.type is MessageType.ANSWER:
+            timeline = timelines.get((peer_id, message.peer_id))
+            if timeline is None or timeline.answer is None:
+                continue
+            if timeline.answer_delivered is None and message.timestamp >= timeline.answer:
+                timeline.answer_delivered = now
+
+# Finished SetupTimelines, oldest first, and a min-heap of (quiet deadline,
+# tiebreak, room id, timeline) for answered ones still open, both guarded by
+# setup_lock. Heap entries are checked lazily like expiry_heaps: a timeline
+# that saw candidates since is pushed back with its new deadline.
+setup_history = deque(maxlen=SETUP_HISTORY)
+setup_heap = []
+setup_lock = threading.Lock()
+setup_tiebreak = itertools.count()
+
+def schedule_setup_finish(room_id, timeline, deadline):
+    """Queues an answered timeline to be finished once it has been quiet until deadline"""
+    with setup_lock:
+        heapq.heappush(setup_heap, (deadline, next(setup_tiebreak), room_id, timeline))
+
+def finish_quiet_setups(now):
+    """Finishes answered setups that have seen no ICE candidate for SETUP_QUIET_MS"""
+    while True:
+        with setup_lock:
+            if not setup_heap or setup_heap[0][0] > now:
+                return
+            deadline, _, room_id, timeline = heapq.heappop(setup_heap)
+        
+        with room_lock(room_id):
+            room = rooms.get(room_id)
+            key = (timeline.offerer, timeline.answerer)
+            # Already finished by a renegotiation or a peer's expiry
+            if room is None or room.timelines.get(key) is not timeline:
+                continue
+            quiet_until = max(timeline.answer, timeline.last_candidate or 0) + SETUP_QUIET_MS / 1000
+            if quiet_until > now:
+                schedule_setup_finish(room_id, timeline, quiet_until)
+                continue
+            del room.timelines[key]
+            finish_setup(timeline)
+
+def finish_setup(timeline):
+    """Archives a finished negotiation's timeline and logs it"""
+    with setup_lock:
+        setup_history.append(timeline)
+    log('info', 'setup', **timeline.to_json())
+
+def percentiles(values):
+    """Nearest-rank SETUP_PERCENTILES of values, None when there are none"""
+    if not values:
+        return None
+    values = sorted(values)
+    return {f'p{p}': values[max(0, math.ceil(p / 100 * len(values)) - 1)] for p in SETUP_PERCENTILES}
+
+def setup_body():
+    """Aggregates the finished setup timelines for GET /setup"""
+    with setup_lock:
+        timelines = list(setup_history)
+    
+    gaps = [timeline.durations() for timeline in timelines]
+    return {
+        'finished': len(timelines),
+        'answered': sum(1 for gap in gaps if gap['offerToAnswer'] is not None),
+        **{
+            name: percentiles([gap[name] for gap in gaps if gap[name] is not None])
+            for name in ('offerToAnswer', 'offerToLastCandidate', 'offerQueued', 'answerTime', 'answerQueued')
+        }
+    }
+
+def setup_log():
+    """The finished setup timelines as JSON lines, oldest first, for GET /setup/log"""
+    with setup_lock:
+        timelines = list(setup_history)
+    return ''.join(json.dumps(timeline.to_json()) + '\n' for timeline in timelines)
+
+def assign_role(room, message):
+    """Applies a sender's declared role to its room (caller holds the room lock)"""
+    if message.role == 'broadcaster':
+        if room.broadcaster != message.peer_id:
+            log('info', 'topology', roomId=message.room_id, broadcaster=message.peer_id, topology='star')
+        room.broadcaster = message.peer_id
+    elif room.broadcaster == message.peer_id:
+        log('info', 'topology', roomId=message.room_id, broadcaster=None, topology='mesh')
+        room.broadcaster = None
+
+def coalesce_candidate(peer, message):
+    """Adds an ICE candidate to the sender's open batch in a peer's mailbox, opening one if needed (caller holds the room lock)"""
+    queue = peer.mailbox.queue
+    tail = queue[-1] if queue else None
+    is_open = isinstance(tail, CandidateBatch) and not tail.closed and tail.peer_id == message.peer_id
+    
+    if message.candidate == '':
+        # End-of-candidates: flush the open batch now rather than at the end of its
+        # window, then relay the marker itself, as happens without coalescing
+        if is_open:
+            tail.closed = True
+        deliver(peer, message)
+        return
+    
+    if is_open:
+        tail.candidates.append(message)
+    else:
+        deliver(peer, CandidateBatch(message))
+
+def coalesce_hold(peer):
+    """Seconds a consumer should still wait for an open ICE batch at the mailbox tail (caller holds the room lock)"""
+    queue = peer.mailbox.queue
+    if not ICE_COALESCE_MS or not queue:
+        return 0
+    tail = queue[-1]
+    if not isinstance(tail, CandidateBatch) or tail.closed:
+        return 0
+    return tail.timestamp + ICE_COALESCE_MS / 1000 - time.time()
+
+def relay(message):
+    """Queues a message for every other peer in the sender's room, returns the recipient count"""
+    with room_lock(message.room_id):
+        return fan_out(get_room(message.room_id), message)
+
+def relay_batch(messages):
+    """Relays messages taking each room lock once per run of same-room messages, returns recipient counts"""
+    counts = []
+    for room_id, group in itertools.groupby(messages, key=lambda message: message.room_id):
+        with room_lock(room_id):
+            room = get_room(room_id)
+            for message in group:
+                counts.append(fan_out(room, message))
+    return counts
+
+def take_messages(room_id, peer_id, wait_ms=0, stream=None, ack=None, piggyback=False):
+    """Drains a peer mailbox, optionally parking up to wait_ms for the first message
+
+    An SSE stream passes its generation (see open_stream) and gets the
+    messages back numbered as (event id, message), or None once a newer
+    stream has taken over the peer. An ?ack= poll passes ack and gets every
+    unacknowledged (seq, message), see release_acked; so does a piggyback
+    take for a peer that polls that way.
+    """
+    wait_ms = min(wait_ms, MAX_PARK_MS)
+    with room_lock(room_id):
+        peer = get_peer(room_id, peer_id)
+        peer.last_poll = time.time()
+        
+        if ack is not None:
+            release_acked(peer, ack)
+        elif piggyback and peer.unacked is not None:
+            ack = 0
         
-        with rooms_lock:
-            if room_id not in rooms:
-                rooms[room_id] = {}
+        if wait_ms and not take_ready(peer, stream, ack):
+            peer.wakeup.wait_for(lambda: take_ready(peer, stream, ack), timeout=wait_ms / 1000)
+            peer.last_poll = time.time()
+        
+        if wait_ms:
+            # Let an open ICE batch fill up for the rest of its window
+            hold = coalesce_hold(peer)
+            while hold > 0:
+                peer.wakeup.wait(hold)
+                hold = coalesce_hold(peer)
+        
+        return collect_messages(room_id, peer_id, peer, stream, ack)
+
+def take_ready(peer, stream, ack):
+    """True when a parked take has something to return (caller holds the room lock)"""
+    if peer.mailbox:
+        return True
+    if ack is not None:
+        # Including messages another poll for this peer drained and numbered
+        return bool(peer.unacked)
+    return stream is not None and stream != peer.stream
+
+def collect_messages(room_id, peer_id, peer, stream, ack):
+    """Drains a peer mailbox for take_messages, numbering the messages for an SSE stream or ?ack= poll
+
+    Numbering in the same critical section as the drain keeps a stale stream
+    or poll from draining messages the one that replaced it would never see,
+    and keeps sequence numbers in mailbox order. Caller holds the room lock.
+    """
+    if stream is not None and stream != peer.stream:
+        return None
+    
+    messages = peer.mailbox.drain()
+    track_delivery(room_id, peer_id, messages)
+    local_metrics().observe_drain(messages)
+    if ack is not None:
+        return sequence_messages(peer, messages)
+    return messages if stream is None else number_events(peer, messages)
+
+def requeue_messages(room_id, peer_id, messages):
+    """Puts drained but undelivered messages back at the head of a peer mailbox"""
+    with room_lock(room_id):
+        get_peer(room_id, peer_id).mailbox.requeue(messages)
+
+async def take_messages_async(room_id, peer_id, wait_ms=0, stream=None, ack=None):
+    """asyncio counterpart of take_messages, parking on the peer's PeerEvent"""
+    wait_ms = min(wait_ms, MAX_PARK_MS)
+    deadline = time.monotonic() + wait_ms / 1000
+    if ack is not None:
+        with room_lock(room_id):
+            release_acked(get_peer(room_id, peer_id), ack)
+    
+    while True:
+        with room_lock(room_id):
+            peer = get_peer(room_id, peer_id)
+            peer.last_poll = time.time()
             
-            other_peer_ids = [pid for pid in rooms[room_id].keys() if pid != peer_id]
+            remaining = deadline - time.monotonic()
+            if take_ready(peer, stream, ack) or remaining <= 0:
+                # Let an open ICE batch fill up for the rest of its window
+                remaining = coalesce_hold(peer) if wait_ms else 0
+                if remaining <= 0:
+                    return collect_messages(room_id, peer_id, peer, stream, ack)
             
-            for other_peer_id in other_peer_ids:
-                if other_peer_id not in rooms[room_id]:
-                    rooms[room_id][other_peer_id] = {'messages': [], 'lastPoll': time.time()}
-                
-                rooms[room_id][other_peer_id]['messages'].append({
-                    'type': 'offer',
-                    'sdp': sdp,
-                    'roomId': room_id,
-                    'peerId': peer_id,
-                    'timestamp': time.time()
-                })
-        
-        print(f'[OFFER] Room: {room_id}, From: {peer_id}, To: {len(other_peer_ids)} peer(s)')
-        
-        return jsonify({
-            'success': True,
-            'message': 'Offer received and forwarded',
-            'forwardedTo': len(other_peer_ids)
-        })
+            wakeup = peer.wakeup
+            wakeup.clear()
+        
+        try:
+            await asyncio.wait_for(wakeup.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+SIGNAL_ACKS = {
+    'offer': 'Offer received and forwarded',
+    'answer': 'Answer received and forwarded',
+    'ice-candidate': 'ICE candidate received and forwarded'
+}
+
+def send_signal(message_type, raw, piggyback=False, idempotency_key=None):
+    """Relays a POSTed offer/answer/ICE candidate body, returns (response body, status) for either engine
+
+    With piggyback the sender's own mailbox is drained into body['messages'],
+    so every send doubles as a poll (see encode_body). A repeated
+    idempotency_key (or messageId) is acknowledged without relaying again.
+    """
+    data, error = parse_json(raw)
+    if error:
+        return {'error': error}, 400
+    
+    if idempotency_key is None and isinstance(data, dict):
+        idempotency_key = data.get('messageId')
+    
+    if idempotency_key is None:
+        body, status, message = relay_signal(message_type, data, raw)
+    else:
+        # Scoped to the sender, so clients that number their messages alike don't collide
+        first = data[0] if isinstance(data, list) and data else data
+        sender = (first.get('roomId'), first.get('peerId', 'unknown')) if isinstance(first, dict) else (None, None)
+        key = (message_type, *sender, str(idempotency_key))
+        
+        replay = claim_signal(key)
+        if replay is not None:
+            body, status = replay
+            if status == 200:
+                body['duplicate'] = True
+                log('info', 'duplicate', type=message_type, roomId=sender[0], peerId=sender[1], key=idempotency_key)
+                if piggyback and sender[0]:
+                    body['messages'] = take_messages(*sender, piggyback=True)
+            return body, status
+        
+        body, status, message = None, 500, None
+        try:
+            body, status, message = relay_signal(message_type, data, raw)
+        finally:
+            settle_signal(key, body, status)
+    
+    if piggyback and message is not None:
+        body['messages'] = take_messages(message.room_id, message.peer_id, piggyback=True)
+    
+    return body, status
+
+def reject_constant(name):
+    """parse_constant hook for parse_json: NaN and Infinity are not JSON"""
+    raise ValueError(f'Invalid JSON: {name} is not allowed')
+
+def unique_keys(pairs):
+    """object_pairs_hook for parse_json, refusing an object that repeats a key"""
+    obj = dict(pairs)
+    if len(obj) != len(pairs):
+        raise ValueError('Invalid JSON: duplicate object key')
+    return obj
+
+def parse_json(raw):
+    """Parses a signaling body as strict JSON, returns (data, error)
+
+    json.loads accepts NaN/Infinity and repeated keys. Bodies are relayed
+    verbatim (see pass_through), so either would reach the other peer: a
+    NaN its parser rejects, or a second "peerId" that differs from the one
+    validated here.
+    """
+    try:
+        return json.loads(raw, parse_constant=reject_constant, object_pairs_hook=unique_keys), None
+    except ValueError as e:
+        return None, str(e)
+
+def relay_signal(message_type, data, raw):
+    """Relays a validated signal for send_signal, returns (response body, status, first relayed message or None)"""
+    if message_type == 'ice-candidate' and isinstance(data, list):
+        return send_candidate_batch(data)
+    
+    message, error = parse_signal(message_type, data, raw)
+    if error:
+        return {'error': error}, 400, None
+    
+    forwarded = relay(message)
+    
+    log('info', message_type, roomId=message.room_id, peerId=message.peer_id, forwardedTo=forwarded)
+    
+    return {
+        'success': True,
+        'message': SIGNAL_ACKS[message_type],
+        'forwardedTo': forwarded
+    }, 200, message
+
+def wants_piggyback(args):
+    """True when a POST asks for its sender's pending messages in the response (?poll=1)"""
+    return args.get('poll', '').lower() in ('1', 'true')
+
+def encode_body(body):
+    """Encodes a response body, splicing a piggybacked 'messages' list in from the cached message JSON
+
+    The list holds (seq, message) pairs for a peer that polls with ?ack=.
+    """
+    messages = body.pop('messages')
+    text = json.dumps(body, separators=(',', ':'))
+    if messages and isinstance(messages[0], tuple):
+        return f'{text[:-1]},"messages":{encode_sequenced(messages)}}}'
+    return f'{text[:-1]},"messages":{encode_messages(messages)}}}'
+
+def send_candidate_batch(items):
+    """Relays a trickle-ICE burst POSTed as a JSON array, with one result per candidate
+
+    Returns (response body, status, first relayed message or None).
+    """
+    if not items:
+        return {'error': 'Missing required fields: candidate, roomId'}, 400, None
+    
+    results = [None] * len(items)
+    messages = []
+    positions = []
+    for index, item in enumerate(items):
+        if isinstance(item, dict):
+            message, error = parse_signal('ice-candidate', item)
+        else:
+            message, error = None, 'Each candidate must be a JSON object'
+        if error:
+            results[index] = {'success': False, 'error': error}
+        else:
+            messages.append(message)
+            positions.append(index)
+    
+    if not messages:
+        return {'error': 'No valid ICE candidates in batch', 'results': results}, 400, None
+    
+    for index, forwarded in zip(positions, relay_batch(messages)):
+        results[index] = {'success': True, 'forwardedTo': forwarded}
+    
+    log('info', 'ice-candidates', roomId=messages[0].room_id, peerId=messages[0].peer_id,
+        candidates=len(messages), received=len(items), forwardedTo=results[positions[0]]['forwardedTo'])
+    
+    return {
+        'success': len(messages) == len(items),
+        'message': 'ICE candidates received and forwarded',
+        'forwardedTo': sum(result['forwardedTo'] for result in results if result['success']),
+        'results': results
+    }, 200, messages[0]
+
+def parse_poll(args):
+    """Validates GET /messages parameters, returns ((room_id, peer_id, wait_ms, ack), error)"""
+    room_id = args.get('roomId')
+    peer_id = args.get('peerId', 'unknown')
+    
+    if not room_id:
+        return None, 'Missing required parameter: roomId'
+    
+    try:
+        wait_ms = int(args.get('wait', 0))
+    except ValueError:
+        return None, 'Invalid parameter: wait must be an integer (ms)'
+    
+    # Absent: the classic destructive poll; present: cursor mode, see release_acked
+    ack = args.get('ack')
+    if ack is not None:
+        try:
+            ack = int(ack)
+        except ValueError:
+            return None, 'Invalid parameter: ack must be an integer (sequence number)'
+        if ack < 0:
+            return None, 'Invalid parameter: ack must be an integer (sequence number)'
+    
+    return (room_id, peer_id, max(0, min(wait_ms, MAX_POLL_WAIT_MS)), ack), None
+
+def release_acked(peer, ack):
+    """Forgets a peer's polled messages up to sequence number ack (caller holds the room lock)
+
+    Messages polled with ?ack= stay with the peer until a later poll
+    acknowledges them, so a lost response is simply sent again. Anything
+    still unacknowledged afterwards makes the poll return at once.
+    """
+    if peer.unacked is None:
+        peer.unacked = deque(maxlen=MAILBOX_CAPACITY)
+    
+    unacked = peer.unacked
+    cutoff = time.time() - MESSAGE_TTL
+    while unacked and (unacked[0][0] <= ack or unacked[0][1].timestamp <= cutoff):
+        unacked.popleft()
+
+def sequence_messages(peer, messages):
+    """Numbers newly polled messages and returns every unacknowledged (seq, message), oldest first
+
+    Caller holds the room lock.
+    """
+    for message in messages:
+        peer.last_event_id += 1
+        peer.unacked.append((peer.last_event_id, message))
+    return list(peer.unacked)
+
+def encode_sequenced(events):
+    """Encodes (seq, message) pairs as the JSON array clients poll for, each message carrying its seq"""
+    now = time.time()
+    return '[' + ','.join(
+        f'{{"seq":{seq},{encode_delivery(message, now).lstrip()[1:]}' for seq, message in events
+    ) + ']'
+
+def parse_stream(args, headers):
+    """Validates GET /events parameters, returns ((room_id, peer_id, last_event_id), error)"""
+    room_id = args.get('roomId')
+    peer_id = args.get('peerId', 'unknown')
+    
+    if not room_id:
+        return None, 'Missing required parameter: roomId'
+    
+    last_event_id = headers.get('Last-Event-ID', args.get('lastEventId'))
+    if last_event_id is not None:
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            return None, 'Invalid Last-Event-ID: must be an integer'
+    
+    return (room_id, peer_id, last_event_id), None
+
+def handle_socket_frame(raw, room_id, peer_id):
+    """Relays one WebSocket text frame, returns an error string or None"""
+    data, error = parse_json(raw)
+    if error:
+        return error
+    
+    try:
+        message_type = data.get('type')
+        if message_type not in SIGNAL_ACKS:
+            return f'Unsupported message type: {message_type}'
+        
+        # The socket is bound to one peer, so its identity comes from the connection
+        message, error = parse_signal(message_type, dict(data, roomId=room_id, peerId=peer_id))
+        if error:
+            return error
+    except (ValueError, AttributeError) as e:
+        return str(e)
+    
+    forwarded = relay(message)
+    log('info', message_type, roomId=room_id, peerId=peer_id, forwardedTo=forwarded, transport='ws')
+    return None
+
+def status_body():
+    """Sums the per-stripe counts for GET /status, without taking any room lock"""
+    room_count = 0
+    total_peers = 0
+    total_messages = 0
+    # Read unlocked, so a relay in flight may be only partly counted
+    for counts in stripe_counts:
+        room_count += counts.rooms
+        total_peers += counts.peers
+        total_messages += counts.messages
+    
+    return {
+        'status': 'running',
+        'port': PORT,
+        'engine': ENGINE,
+        'rooms': room_count,
+        'totalPeers': total_peers,
+        'totalPendingMessages': total_messages,
+        'timestamp': datetime.now().isoformat()
+    }
+
+def render_histogram(lines, name, histogram, labels=''):
+    """Appends a histogram's cumulative _bucket, _sum and _count samples in Prometheus text format"""
+    cumulative = 0
+    for bound, count in zip(histogram.bounds + ('+Inf',), histogram.buckets):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+    labels = f'{{{labels[:-1]}}}' if labels else ''
+    lines.append(f'{name}_sum{labels} {histogram.sum}')
+    lines.append(f'{name}_count{labels} {histogram.count}')
+
+def metrics_text():
+    """Renders GET /metrics in the Prometheus text exposition format"""
+    metrics = collect_metrics()
+    status = status_body()
+    lines = [
+        '# HELP signaling_requests_total Signaling requests handled, by route and status code',
+        '# TYPE signaling_requests_total counter'
+    ]
+    for (route, code), count in sorted(metrics.requests.items()):
+        lines.append(f'signaling_requests_total{{route="{route}",code="{code}"}} {count}')
+    
+    lines.append('# HELP signaling_request_duration_seconds Time to build a response, by route')
+    lines.append('# TYPE signaling_request_duration_seconds histogram')
+    for route, histogram in sorted(metrics.latency.items()):
+        render_histogram(lines, 'signaling_request_duration_seconds', histogram, f'route="{route}",')
+    
+    lines.append('# HELP signaling_fan_out_recipients Mailboxes each relayed message was queued for')
+    lines.append('# TYPE signaling_fan_out_recipients histogram')
+    render_histogram(lines, 'signaling_fan_out_recipients', metrics.fan_out)
+    
+    lines.append('# HELP signaling_mailbox_depth Messages a mailbox held when drained by a poll, stream or socket')
+    lines.append('# TYPE signaling_mailbox_depth histogram')
+    render_histogram(lines, 'signaling_mailbox_depth', metrics.mailbox_depth)
+    
+    lines.append('# HELP signaling_queue_delay_seconds Time a message waited between enqueue and delivery, by type')
+    lines.append('# TYPE signaling_queue_delay_seconds histogram')
+    for message_type, histogram in sorted(metrics.queue_delay.items()):
+        render_histogram(lines, 'signaling_queue_delay_seconds', histogram, f'type="{message_type}",')
+    
+    lines.append('# HELP signaling_expired_messages_total Undelivered messages dropped after SIGNALING_MESSAGE_TTL')
+    lines.append('# TYPE signaling_expired_messages_total counter')
+    lines.append(f'signaling_expired_messages_total {metrics.expired}')
+    
+    for name, key, text in (
+        ('signaling_rooms', 'rooms', 'Open rooms'),
+        ('signaling_peers', 'totalPeers', 'Registered peers'),
+        ('signaling_pending_messages', 'totalPendingMessages', 'Messages waiting in mailboxes')
+    ):
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {status[key]}')
+    
+    return '\n'.join(lines) + '\n'
+
+def signal_response(body, status):
+    """Flask response for send_signal's result"""
+    if 'messages' in body:
+        return Response(encode_body(body), status=status, mimetype='application/json')
+    return jsonify(body), status
+
+def read_signal_body():
+    """Returns the POSTed body's text, parsed by send_signal and kept for pass-through relay"""
+    return request.get_data(as_text=True)
+
+@app.route('/offer', methods=['POST'])
+def handle_offer():
+    """Receives an offer from a peer (usually the Android phone)"""
+    try:
+        body, status = send_signal('offer', read_signal_body(), piggyback=wants_piggyback(request.args),
+                                   idempotency_key=request.headers.get('Idempotency-Key'))
+        return signal_response(body, status)
     except Exception as e:
-        print(f'Error handling offer: {e}')
+        log('error', 'request_error', route='/offer', error=str(e))
         return jsonify({'error': str(e)}), 500
 
 @app.route('/ice-candidate', methods=['POST'])
 def handle_ice_candidate():
-    """Receives an ICE candidate from a peer"""
+    """Receives an ICE candidate from a peer, or a JSON array of them relayed as one batch"""
     try:
-        data = request.json
-        candidate = data.get('candidate')
-        sdp_mid = data.get('sdpMid', '')
-        sdp_m_line_index = data.get('sdpMLineIndex', 0)
-        room_id = data.get('roomId')
-        peer_id = data.get('peerId', 'unknown')
-        
-        if not candidate or not room_id:
-            return jsonify({'error': 'Missing required fields: candidate, roomId'}), 400
-        
-        with rooms_lock:
-            if room_id not in rooms:
-                rooms[room_id] = {}
-            
-            # Get all other peers in the room
-            other_peer_ids = [pid for pid in rooms[room_id].keys() if pid != peer_id]
-            
-            # Forward ICE candidate to other peers
-            for other_peer_id in other_peer_ids:
-                if other_peer_id not in rooms[room_id]:
-                    rooms[room_id][other_peer_id] = {'messages': [], 'lastPoll': time.time()}
-                
-                rooms[room_id][other_peer_id]['messages'].append({
-                    'type': 'ice-candidate',
-                    'candidate': candidate,
-                    'sdpMid': sdp_mid,
-                    'sdpMLineIndex': sdp_m_line_index,
-                    'roomId': room_id,
-                    'peerId': peer_id,
-                    'timestamp': time.time()
-                })
-        
-        print(f'[ICE] Room: {room_id}, From: {peer_id}, To: {len(other_peer_ids)} peer(s)')
-        
-        return jsonify({
-            'success': True,
-            'message': 'ICE candidate received and forwarded',
-            'forwardedTo': len(other_peer_ids)
-        })
+        body, status = send_signal('ice-candidate', read_signal_body(), piggyback=wants_piggyback(request.args),
+                                   idempotency_key=request.headers.get('Idempotency-Key'))
+        return signal_response(body, status)
     except Exception as e:
-        print(f'Error handling ICE candidate: {e}')
+        log('error', 'request_error', route='/ice-candidate', error=str(e))
         return jsonify({'error': str(e)}), 500
 
 @app.route('/messages', methods=['GET'])
 def poll_messages():
-    """Polls for incoming messages (answer, ICE candidates)"""
+    """Polls for incoming messages (answer, ICE candidates)
+
+    With ?wait=<ms> the request is held open until a message arrives for this
+    peer or the timeout expires (long-polling), instead of returning [] at once.
+    With ?ack=<seq> every message carries a per-peer "seq" and is returned
+    again by each poll until a later poll acknowledges it (start with ack=0).
+    """
     try:
-        room_id = request.args.get('roomId')
-        peer_id = request.args.get('peerId', 'unknown')
+        params, error = parse_poll(request.args)
+        if error:
+            return jsonify({'error': error}), 400
+        room_id, peer_id, wait_ms, ack = params
         
-        if not room_id:
-            return jsonify({'error': 'Missing required parameter: roomId'}), 400
+        if ack is not None:
+            events = take_messages(room_id, peer_id, wait_ms, ack=ack)
+            log('info', 'poll', roomId=room_id, peerId=peer_id, ack=ack, messages=len(events))
+            return Response(encode_sequenced(events), mimetype='application/json')
         
-        with rooms_lock:
-            if room_id not in rooms:
-                rooms[room_id] = {}
-            if peer_id not in rooms[room_id]:
-                rooms[room_id][peer_id] = {'messages': [], 'lastPoll': time.time()}
-            
-            peer_data = rooms[room_id][peer_id]
-            peer_data['lastPoll'] = time.time()
-            
-            messages = peer_data['messages'].copy()
-            peer_data['messages'] = []
+        messages = take_messages(room_id, peer_id, wait_ms)
         
-        print(f'[POLL] Room: {room_id}, Peer: {peer_id}, Messages: {len(messages)}')
+        log('info', 'poll', roomId=room_id, peerId=peer_id, messages=len(messages))
         
-        return jsonify(messages)
+        return Response(encode_messages(messages), mimetype='application/json')
     except Exception as e:
-        print(f'Error polling messages: {e}')
+        log('error', 'request_error', route='/messages', error=str(e))
         return jsonify({'error': str(e)}), 500
 
 @app.route('/answer', methods=['POST'])
 def handle_answer():
     """Receives an answer from a peer (usually the receiving device)"""
     try:
-        data = request.json
-        sdp = data.get('sdp')
-        room_id = data.get('roomId')
-        peer_id = data.get('peerId', 'unknown')
+        body, status = send_signal('answer', read_signal_body(), piggyback=wants_piggyback(request.args),
+                                   idempotency_key=request.headers.get('Idempotency-Key'))
+        return signal_response(body, status)
+    except Exception as e:
+        log('error', 'request_error', route='/answer', error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+def number_events(peer, messages):
+    """Assigns per-peer SSE event ids and remembers the events for Last-Event-ID resume (caller holds the room lock)"""
+    if peer.sent_events is None:
+        peer.sent_events = deque(maxlen=SSE_REPLAY_SIZE)
+    
+    events = []
+    for message in messages:
+        peer.last_event_id += 1
+        events.append((peer.last_event_id, message))
+    peer.sent_events.extend(events)
+    return events
+
+def open_stream(room_id, peer_id, last_event_id):
+    """Makes a new SSE stream the peer's only one, returns (its generation, events newer than last_event_id)
+
+    A stream the client has already abandoned may still be parked in
+    take_messages; bumping the generation wakes it and stops it draining, so
+    everything it numbered before is in sent_events for this replay.
+    """
+    with room_lock(room_id):
+        peer = get_peer(room_id, peer_id)
+        peer.stream += 1
+        peer.wakeup.notify_all()
         
-        if not sdp or not room_id:
-            return jsonify({'error': 'Missing required fields: sdp, roomId'}), 400
+        if last_event_id is None or peer.sent_events is None:
+            return peer.stream, []
+        return peer.stream, [event for event in peer.sent_events if event[0] > last_event_id]
+
+def format_event(event_id, message):
+    """Encodes one mailbox message as an SSE frame"""
+    return f'id: {event_id}\ndata: {encode_delivery(message, time.time())}\n\n'
+
+def stream_events(room_id, peer_id, stream, events):
+    """Yields SSE frames for a peer mailbox: replayed events, new messages and heartbeats
+
+    Ends once a reconnect has opened a newer stream for the peer.
+    """
+    # Ask EventSource to reconnect quickly instead of its multi-second default
+    yield 'retry: 1000\n\n'
+    
+    while True:
+        for event_id, message in events:
+            yield format_event(event_id, message)
         
-        with rooms_lock:
-            if room_id not in rooms:
-                rooms[room_id] = {}
-            
-            other_peer_ids = [pid for pid in rooms[room_id].keys() if pid != peer_id]
-            
-            for other_peer_id in other_peer_ids:
-                if other_peer_id not in rooms[room_id]:
-                    rooms[room_id][other_peer_id] = {'messages': [], 'lastPoll': time.time()}
-                
-                rooms[room_id][other_peer_id]['messages'].append({
-                    'type': 'answer',
-                    'sdp': sdp,
-                    'roomId': room_id,
-                    'peerId': peer_id,
-                    'timestamp': time.time()
-                })
-        
-        print(f'[ANSWER] Room: {room_id}, From: {peer_id}, To: {len(other_peer_ids)} peer(s)')
-        
-        return jsonify({
-            'success': True,
-            'message': 'Answer received and forwarded',
-            'forwardedTo': len(other_peer_ids)
-        })
+        events = take_messages(room_id, peer_id, SSE_HEARTBEAT_MS, stream)
+        if events is None:
+            return
+        if not events:
+            yield ': heartbeat\n\n'
+
+@app.route('/events', methods=['GET'])
+def stream_messages():
+    """Streams incoming messages as Server-Sent Events (one message per event)
+
+    Drains the same mailbox as GET /messages. A reconnecting client sends
+    Last-Event-ID (or ?lastEventId=) to get recently streamed events again.
+    """
+    try:
+        params, error = parse_stream(request.args, request.headers)
+        if error:
+            return jsonify({'error': error}), 400
+        room_id, peer_id, last_event_id = params
+        
+        # Also registers the peer, so the room sees it before the stream starts
+        stream, events = open_stream(room_id, peer_id, last_event_id)
+        
+        log('info', 'sse_connect', roomId=room_id, peerId=peer_id, lastEventId=last_event_id)
+        
+        return Response(
+            stream_events(room_id, peer_id, stream, events),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
     except Exception as e:
-        print(f'Error handling answer: {e}')
+        log('error', 'request_error', route='/events', error=str(e))
         return jsonify({'error': str(e)}), 500
 
+def push_messages(ws, send_lock, room_id, peer_id):
+    """Forwards a WebSocket peer's mailbox to its socket as messages arrive"""
+    while ws.connected:
+        messages = take_messages(room_id, peer_id, WS_PUSH_WAIT_MS)
+        if not messages:
+            continue
+        try:
+            with send_lock:
+                ws.send(encode_messages(messages))
+        except ConnectionClosed:
+            requeue_messages(room_id, peer_id, messages)
+            break
+
+@sock.route('/ws')
+def signaling_socket(ws):
+    """WebSocket signaling (/ws?roomId=&peerId=)
+
+    Accepts the same offer/answer/ice-candidate JSON as the HTTP routes and
+    pushes queued messages to the peer as JSON arrays, like GET /messages.
+    """
+    room_id = request.args.get('roomId')
+    peer_id = request.args.get('peerId', 'unknown')
+    
+    if not room_id:
+        ws.send(json.dumps({'error': 'Missing required parameter: roomId'}))
+        return
+    
+    send_lock = threading.Lock()
+    pusher = threading.Thread(target=push_messages, args=(ws, send_lock, room_id, peer_id), daemon=True)
+    pusher.start()
+    
+    log('info', 'ws_connect', roomId=room_id, peerId=peer_id)
+    
+    try:
+        while True:
+            error = handle_socket_frame(ws.receive(), room_id, peer_id)
+            if error:
+                with send_lock:
+                    ws.send(json.dumps({'error': error}))
+    except ConnectionClosed:
+        pass
+    finally:
+        pusher.join()
+        log('info', 'ws_disconnect', roomId=room_id, peerId=peer_id)
+
 @app.route('/status', methods=['GET'])
 def get_status():
     """Check server status and room information"""
-    with rooms_lock:
-        room_count = len(rooms)
-        total_peers = sum(len(peers) for peers in rooms.values())
-        total_messages = sum(
-            len(peer_data['messages'])
-            for room in rooms.values()
-            for peer_data in room.values()
-        )
+    return jsonify(status_body())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/setup', methods=['GET'])
+def get_setup():
+    """Connection-setup percentiles (ms) over recently finished negotiations"""
+    return jsonify(setup_body())
+
+@app.route('/setup/log', methods=['GET'])
+def get_setup_log():
+    """Recently finished setup timelines as JSON lines"""
+    return Response(setup_log(), mimetype='application/x-ndjson')
+
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Counts and times the signaling routes; streamed bodies are timed up to their headers"""
+    if request.path in METRIC_ROUTES and request.method != 'OPTIONS':
+        local_metrics().observe_request(request.path, response.status_code, time.perf_counter() - g.started)
+    return response
+
+# asyncio engine (SIGNALING_ENGINE=asyncio): the same routes and JSON served by
+# aiohttp, sharing the mailbox helpers above with the Flask handlers.
+
+def json_response(body, status=200):
+    """aiohttp response matching Flask's jsonify output"""
+    return web.json_response(body, status=status, dumps=lambda obj: json.dumps(obj, sort_keys=True))
+
+def signal_response_async(body, status):
+    """aiohttp response for send_signal's result"""
+    if 'messages' in body:
+        return web.Response(text=encode_body(body), status=status, content_type='application/json')
+    return json_response(body, status)
+
+async def offer_async(request):
+    """Receives an offer from a peer (asyncio engine)"""
+    try:
+        body, status = send_signal('offer', await request.text(), piggyback=wants_piggyback(request.query),
+                                   idempotency_key=request.headers.get('Idempotency-Key'))
+        return signal_response_async(body, status)
+    except Exception as e:
+        log('error', 'request_error', route='/offer', error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+async def answer_async(request):
+    """Receives an answer from a peer (asyncio engine)"""
+    try:
+        body, status = send_signal('answer', await request.text(), piggyback=wants_piggyback(request.query),
+                                   idempotency_key=request.headers.get('Idempotency-Key'))
+        return signal_response_async(body, status)
+    except Exception as e:
+        log('error', 'request_error', route='/answer', error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+async def ice_candidate_async(request):
+    """Receives an ICE candidate from a peer (asyncio engine)"""
+    try:
+        body, status = send_signal('ice-candidate', await request.text(), piggyback=wants_piggyback(request.query),
+                                   idempotency_key=request.headers.get('Idempotency-Key'))
+        return signal_response_async(body, status)
+    except Exception as e:
+        log('error', 'request_error', route='/ice-candidate', error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+async def poll_messages_async(request):
+    """Polls for incoming messages, long-polling on ?wait=<ms> (asyncio engine)"""
+    try:
+        params, error = parse_poll(request.query)
+        if error:
+            return json_response({'error': error}, 400)
+        room_id, peer_id, wait_ms, ack = params
+        
+        if ack is not None:
+            events = await take_messages_async(room_id, peer_id, wait_ms, ack=ack)
+            log('info', 'poll', roomId=room_id, peerId=peer_id, ack=ack, messages=len(events))
+            return web.Response(text=encode_sequenced(events), content_type='application/json')
+        
+        messages = await take_messages_async(room_id, peer_id, wait_ms)
+        
+        log('info', 'poll', roomId=room_id, peerId=peer_id, messages=len(messages))
+        
+        return web.Response(text=encode_messages(messages), content_type='application/json')
+    except Exception as e:
+        log('error', 'request_error', route='/messages', error=str(e))
+        return json_response({'error': str(e)}, 500)
+
+async def status_async(request):
+    """Check server status and room information (asyncio engine)"""
+    return json_response(status_body())
+
+async def setup_async(request):
+    """Connection-setup percentiles (asyncio engine)"""
+    return json_response(setup_body())
+
+async def setup_log_async(request):
+    """Recently finished setup timelines as JSON lines (asyncio engine)"""
+    return web.Response(text=setup_log(), content_type='application/x-ndjson')
+
+async def metrics_async(request):
+    """Prometheus scrape endpoint (asyncio engine)"""
+    return web.Response(text=metrics_text(), content_type='text/plain')
+
+async def stream_messages_async(request):
+    """Streams incoming messages as Server-Sent Events (asyncio engine)"""
+    params, error = parse_stream(request.query, request.headers)
+    if error:
+        return json_response({'error': error}, 400)
+    room_id, peer_id, last_event_id = params
     
-    return jsonify({
-        'status': 'running',
-        'port': PORT,
-        'rooms': room_count,
-        'totalPeers': total_peers,
-        'totalPendingMessages': total_messages,
-        'timestamp': datetime.now().isoformat()
+    stream, events = open_stream(room_id, peer_id, last_event_id)
+    
+    log('info', 'sse_connect', roomId=room_id, peerId=peer_id, lastEventId=last_event_id)
+    
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
+    await response.prepare(request)
+    await response.write(b'retry: 1000\n\n')
+    
+    while True:
+        for event_id, message in events:
+            await response.write(format_event(event_id, message).encode())
+        
+        events = await take_messages_async(room_id, peer_id, SSE_HEARTBEAT_MS, stream)
+        if events is None:
+            return response
+        if not events:
+            await response.write(b': heartbeat\n\n')
+
+async def push_messages_async(ws, room_id, peer_id):
+    """Forwards a WebSocket peer's mailbox to its socket as messages arrive (asyncio engine)"""
+    while not ws.closed:
+        messages = await take_messages_async(room_id, peer_id, WS_PUSH_WAIT_MS)
+        if not messages:
+            continue
+        try:
+            await ws.send_str(encode_messages(messages))
+        except ConnectionError:
+            requeue_messages(room_id, peer_id, messages)
+            break
+
+async def signaling_socket_async(request):
+    """WebSocket signaling (/ws?roomId=&peerId=) (asyncio engine)"""
+    room_id = request.query.get('roomId')
+    peer_id = request.query.get('peerId', 'unknown')
+    
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    
+    if not room_id:
+        await ws.send_str(json.dumps({'error': 'Missing required parameter: roomId'}))
+        await ws.close()
+        return ws
+    
+    pusher = asyncio.create_task(push_messages_async(ws, room_id, peer_id))
+    
+    log('info', 'ws_connect', roomId=room_id, peerId=peer_id)
+    
+    try:
+        async for frame in ws:
+            if frame.type != WSMsgType.TEXT:
+                continue
+            error = handle_socket_frame(frame.data, room_id, peer_id)
+            if error:
+                await ws.send_str(json.dumps({'error': error}))
+    finally:
+        await pusher
+        log('info', 'ws_disconnect', roomId=room_id, peerId=peer_id)
+    
+    return ws
+
+def create_async_app():
+    """Builds the aiohttp application for the asyncio engine"""
+    
+    @web.middleware
+    async def cors(request, handler):
+        # Mirrors flask_cors defaults: any origin, answer preflights directly
+        if request.method == 'OPTIONS':
+            response = web.Response()
+            response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+            response.headers['Access-Control-Allow-Headers'] = request.headers.get('Access-Control-Request-Headers', '*')
+        else:
+            response = await handler(request)
+        if not response.prepared:
+            response.headers['Access-Control-Allow-Origin'] = '*'
+        return response
+    
+    @web.middleware
+    async def request_metrics(request, handler):
+        if request.path not in METRIC_ROUTES or request.method == 'OPTIONS':
+            return await handler(request)
+        started = time.perf_counter()
+        response = await handler(request)
+        local_metrics().observe_request(request.path, response.status, time.perf_counter() - started)
+        return response
+    
+    async_app = web.Application(middlewares=[cors, request_metrics])
+    async_app.add_routes([
+        web.post('/offer', offer_async),
+        web.post('/answer', answer_async),
+        web.post('/ice-candidate', ice_candidate_async),
+        web.get('/messages', poll_messages_async),
+        web.get('/status', status_async),
+        web.get('/metrics', metrics_async),
+        web.get('/setup', setup_async),
+        web.get('/setup/log', setup_log_async),
+        web.get('/events', stream_messages_async),
+        web.get('/ws', signaling_socket_async),
+        # Preflights are answered by the cors middleware before this handler runs
+        web.options('/{tail:.*}', status_async)
+    ])
+    return async_app
 
 if __name__ == '__main__':
     print('=' * 40)
     print('WebRTC Signaling Server (Python)')
     print('=' * 40)
-    print(f'Server running on http://localhost:{PORT}')
+    print(f'Server running on http://localhost:{PORT} (engine: {ENGINE})')
     print(f'Status: http://localhost:{PORT}/status')
     print('')
     print('Endpoints:')
-    print('  POST /offer          - Send WebRTC offer')
+    print('  POST /offer          - Send WebRTC offer (?poll=1 to get pending messages back)')
     print('  POST /answer         - Send WebRTC answer')
-    print('  POST /ice-candidate  - Send ICE candidate')
-    print('  GET  /messages       - Poll for messages')
+    print('  POST /ice-candidate  - Send ICE candidate (or a JSON array of them)')
+    print('  GET  /messages       - Poll for messages (?wait=<ms> to long-poll, ?ack=<seq> to acknowledge)')
     print('  GET  /status         - Server status')
+    print('  GET  /metrics        - Prometheus metrics')
+    print('  GET  /setup          - Connection-setup percentiles (/setup/log for the timelines)')
+    print('  GET  /events         - Server-Sent Events stream')
+    print('  WS   /ws             - WebSocket signaling (push)')
+    print('')
+    print('Send "role": "broadcaster" with a signal to make its room a star (viewers only reach the broadcaster)')
     print('=' * 40)
     
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    if ENGINE == 'asyncio':
+        if web is None:
+            raise SystemExit('SIGNALING_ENGINE=asyncio requires aiohttp (pip install aiohttp)')
+        web.run_app(create_async_app(), host='0.0.0.0', port=PORT, print=None)
+    elif ENGINE == 'flask':
+        app.run(host='0.0.0.0', port=PORT, debug=False)
+    else:
+        raise SystemExit(f'Unknown SIGNALING_ENGINE: {ENGINE} (expected flask or asyncio)')
 